@@ -1,125 +1,273 @@
 # backend/data_loader.py
-import json
+import hashlib
+import os
+import orjson
+from functools import lru_cache
 from pathlib import Path
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-DATASET_FILE = Path("data.json")
-POLICY_FOLDER = Path("attachment")
+BASE_DIR = Path(__file__).parent.parent
+DATASET_FILE = BASE_DIR / "data.json"
+POLICY_FOLDER = BASE_DIR / "attachment"
 
 # ---------------------------
-# Load main dataset
+# Load main dataset (parsed once, shared with main.py)
 # ---------------------------
-with open(DATASET_FILE, "r", encoding="utf-8") as f:
-    data = json.load(f)
+bus_data = orjson.loads(DATASET_FILE.read_bytes())
 
-districts = data["districts"]
-providers = data["bus_providers"]
+districts = bus_data["districts"]
+providers = bus_data["bus_providers"]
 
 # ---------------------------
-# Chunk storage container
+# Policy chunking settings
 # ---------------------------
-all_chunks = []
+# Sizes are in tokens of the embedding model, so chunks are never silently
+# truncated at embedding time. all-MiniLM-L6-v2 reads at most 256 tokens,
+# two of which are the [CLS]/[SEP] it adds itself.
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+MAX_SEQ_LENGTH = 256
+MAX_CHUNK_TOKENS = MAX_SEQ_LENGTH - 2
+TOKENS_PER_CHUNK = 200
+CHUNK_OVERLAP = 20
+MIN_CHUNK_TOKENS = 100
+CHUNKING_VERSION = 3   # bump when the split/merge logic changes, to force re-ingest
 
-# ---------------------------
-# District & Dropping Point Chunks
-# ---------------------------
-for district in districts:
-    # District block summary
-    text = f"District: {district['name']}\nDropping points:\n"
-
-    for dp in district["dropping_points"]:
-        text += f"• {dp['name']} — {dp['price']} Taka\n"
-
-    all_chunks.append({
-        "content": text,
-        "metadata": {
-            "type": "district",
-            "district": district["name"]
-        }
-    })
-
-    # Individual dropping points
-    for dp in district["dropping_points"]:
-        dp_text = (
-            f"Dropping point: {dp['name']} in {district['name']}.\n"
-            f"Fare: {dp['price']} Taka."
-        )
+OUTPUT_FILE = "chunks.txt"
 
-        all_chunks.append({
-            "content": dp_text,
-            "metadata": {
-                "type": "dropping_point",
-                "district": district["name"],
-                "point": dp["name"],
-                "price": dp["price"]
-            }
-        })
 
-# ---------------------------
-# Provider Chunks (Desh, Hanif, Ena, etc.)
-# ---------------------------
-for provider in providers:
-    provider_text = (
-        f"Bus Provider: {provider['name']}\n"
-        f"Coverage Districts: {', '.join(provider['coverage_districts'])}"
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    """Load the embedding model's tokenizer only when chunks are built."""
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+
+
+@lru_cache(maxsize=1)
+def get_text_splitter():
+    """
+    Recursive splitter measured in model tokens. The tokenizer only counts
+    length, so chunks keep the original text (case, newlines, structure).
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    # No overlap at split time: merging overlapping splits would repeat the
+    # shared text inside a chunk. add_overlap() applies it to the final chunks.
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        get_tokenizer(),
+        chunk_size=TOKENS_PER_CHUNK,
+        chunk_overlap=0
     )
 
-    all_chunks.append({
-        "content": provider_text,
-        "metadata": {
-            "type": "provider",
-            "provider": provider["name"].lower(),
-            "districts": provider["coverage_districts"]
-        }
-    })
 
-# ---------------------------
-# Policy Chunks (Hanif.txt, Ena.txt, etc.)
-# ---------------------------
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=500,
-    chunk_overlap=150
-)
+def count_tokens(text: str) -> int:
+    """Token count excluding the [CLS]/[SEP] special tokens."""
+    return len(get_tokenizer().encode(text, add_special_tokens=False))
+
+
+def split_spans(text: str, splits) -> list[tuple[int, int]]:
+    """(start, end) of each split in text. Splits are non-overlapping and in order."""
+    spans = []
+    cursor = 0
+    for split in splits:
+        start = text.index(split, cursor)
+        cursor = start + len(split)
+        spans.append((start, cursor))
+    return spans
+
+
+def merge_splits(text: str, spans, chunk_size=TOKENS_PER_CHUNK, min_size=MIN_CHUNK_TOKENS,
+                 max_size=MAX_CHUNK_TOKENS, length_function=count_tokens) -> list[tuple[int, int]]:
+    """
+    Split-then-merge post pass over the splitter output, as spans of text.
+    Merged chunks are slices of the original text, so the separators the
+    splitter cut on are kept as they were.
+    1. Greedily merge adjacent fragments while they fit in chunk_size.
+    2. Fold any fragment still under min_size into its neighbour,
+       as long as the result stays within max_size.
+    """
+    merged = []
+    for start, end in spans:
+        if merged and length_function(text[merged[-1][0]:end]) <= chunk_size:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    result = []
+    for start, end in merged:
+        if result:
+            previous_start, previous_end = result[-1]
+            is_small = min(length_function(text[start:end]),
+                           length_function(text[previous_start:previous_end])) < min_size
+            if is_small and length_function(text[previous_start:end]) <= max_size:
+                result[-1] = (previous_start, end)
+                continue
+        result.append((start, end))
+    return result
+
+
+def overlap_start(text: str, span: tuple[int, int], overlap: int) -> int:
+    """Offset where (about) the last `overlap` tokens of span begin, on a word boundary."""
+    start, end = span
+    offsets = get_tokenizer()(text[start:end], add_special_tokens=False,
+                              return_offsets_mapping=True)["offset_mapping"]
+    if len(offsets) <= overlap:
+        return start
+    begin = start + offsets[-overlap][0]
+    while start < begin < end and not text[begin - 1].isspace():
+        begin += 1
+    while begin < end and text[begin].isspace():
+        begin += 1
+    return begin
 
-policy_files = list(POLICY_FOLDER.glob("*.txt"))
 
-for txt_file in policy_files:
-    provider_name = txt_file.stem.lower()
+def add_overlap(text: str, spans, overlap=CHUNK_OVERLAP, max_size=MAX_CHUNK_TOKENS,
+                length_function=count_tokens) -> list[str]:
+    """
+    Chunk texts, each extended back into the previous chunk by about
+    `overlap` tokens of original text, staying within max_size.
+    """
+    chunks = [text[start:end] for start, end in spans[:1]]
+    for previous, (start, end) in zip(spans, spans[1:]):
+        chunk = text[start:end]
+        room = min(overlap, max_size - length_function(chunk))
+        if room > 0:
+            candidate = text[overlap_start(text, previous, room):end]
+            if length_function(candidate) <= max_size:
+                chunk = candidate
+        chunks.append(chunk)
+    return chunks
 
-    with open(txt_file, "r", encoding="utf-8") as f:
-        policy_text = f.read().strip()
 
-    wrapped_text = f"Policy of {provider_name} bus:\n\n{policy_text}"
+def source_fingerprint() -> str:
+    """
+    Hash of every input that shapes the chunks (dataset, policy files and
+    chunking settings). Stored with the vector DB to detect stale data.
+    """
+    digest = hashlib.sha256()
+    digest.update(DATASET_FILE.read_bytes())
+    for txt_file in sorted(POLICY_FOLDER.glob("*.txt")):
+        digest.update(txt_file.name.encode("utf-8"))
+        digest.update(txt_file.read_bytes())
+    digest.update(f"{EMBEDDING_MODEL_NAME}|{TOKENS_PER_CHUNK}|{CHUNK_OVERLAP}|{MIN_CHUNK_TOKENS}|{MAX_CHUNK_TOKENS}|{CHUNKING_VERSION}".encode("utf-8"))
+    return digest.hexdigest()
 
-    chunks = text_splitter.split_text(wrapped_text)
 
-    for i, chunk in enumerate(chunks):
+def build_chunks() -> list[dict]:
+    """
+    Build all district, dropping point, provider and policy chunks.
+    Metadata is Chroma-ready: scalar values only, provider names lowercased.
+    """
+    all_chunks = []
+
+    # ---------------------------
+    # District & Dropping Point Chunks
+    # ---------------------------
+    for district in districts:
+        # District block summary
+        text = f"District: {district['name']}\nDropping points:\n"
+
+        for dp in district["dropping_points"]:
+            text += f"• {dp['name']} — {dp['price']} Taka\n"
+
         all_chunks.append({
-            "content": chunk,
+            "content": text,
             "metadata": {
-                "type": "policy",
-                "provider": provider_name,
-                "chunk_index": i
+                "type": "district",
+                "district": district["name"]
             }
         })
 
-# --------------- SUMMARY ----------------
-print("\n======================================")
-print("Total Chunks Created:", len(all_chunks))
-print("======================================\n")
+        # Individual dropping points
+        for dp in district["dropping_points"]:
+            dp_text = (
+                f"Dropping point: {dp['name']} in {district['name']}.\n"
+                f"Fare: {dp['price']} Taka."
+            )
 
-OUTPUT_FILE = "chunks.txt"
+            all_chunks.append({
+                "content": dp_text,
+                "metadata": {
+                    "type": "dropping_point",
+                    "district": district["name"],
+                    "point": dp["name"],
+                    "price": dp["price"]
+                }
+            })
+
+    # ---------------------------
+    # Provider Chunks (Desh, Hanif, Ena, etc.)
+    # ---------------------------
+    for provider in providers:
+        provider_text = (
+            f"Bus Provider: {provider['name']}\n"
+            f"Coverage Districts: {', '.join(provider['coverage_districts'])}"
+        )
+
+        all_chunks.append({
+            "content": provider_text,
+            "metadata": {
+                "type": "provider",
+                "provider": provider["name"].strip().lower(),
+                "districts": ", ".join(provider["coverage_districts"])
+            }
+        })
+
+    # ---------------------------
+    # Policy Chunks (Hanif.txt, Ena.txt, etc.)
+    # ---------------------------
+    text_splitter = get_text_splitter()
+
+    for txt_file in POLICY_FOLDER.glob("*.txt"):
+        provider_name = txt_file.stem.strip().lower()
+
+        with open(txt_file, "r", encoding="utf-8") as f:
+            policy_text = f.read().strip()
+
+        wrapped_text = f"Policy of {provider_name} bus:\n\n{policy_text}"
+
+        spans = split_spans(wrapped_text, text_splitter.split_text(wrapped_text))
+        chunks = add_overlap(wrapped_text, merge_splits(wrapped_text, spans))
+
+        for i, chunk in enumerate(chunks):
+            all_chunks.append({
+                "content": chunk,
+                "metadata": {
+                    "type": "policy",
+                    "provider": provider_name,
+                    "chunk_index": i
+                }
+            })
+
+    # --------------- SUMMARY ----------------
+    print("\n======================================")
+    print("Total Chunks Created:", len(all_chunks))
+    print("======================================\n")
+
+    # Debug dump, opt-in via DUMP_CHUNKS=1
+    if os.environ.get("DUMP_CHUNKS") == "1":
+        dump_chunks(all_chunks)
+
+    return all_chunks
+
+
+def dump_chunks(all_chunks: list[dict], output_file: str = OUTPUT_FILE):
+    """Write chunks to a text file for inspection."""
+    separator = "=" * 60
+    divider = "-" * 60
+
+    # Build each chunk's block in memory and write it with one call
+    with open(output_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+        for index, chunk in enumerate(all_chunks):
+            metadata_lines = "".join(f"  {k}: {v}\n" for k, v in chunk["metadata"].items())
+            f.write(
+                f"{separator}\n"
+                f"CHUNK #{index}\n"
+                f"{divider}\n"
+                "CONTENT:\n"
+                f"{chunk['content']}\n\n"
+                "METADATA:\n"
+                f"{metadata_lines}"
+                f"{separator}\n\n"
+            )
 
-with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-    for index, chunk in enumerate(all_chunks):
-        f.write("============================================================\n")
-        f.write(f"CHUNK #{index}\n")
-        f.write("------------------------------------------------------------\n")
-        f.write("CONTENT:\n")
-        f.write(chunk["content"] + "\n\n")
-        f.write("METADATA:\n")
-        for k, v in chunk["metadata"].items():
-            f.write(f"  {k}: {v}\n")
-        f.write("============================================================\n\n")
-
-print(f"Dumped {len(all_chunks)} chunks to chunks.txt")
\ No newline at end of file
+    print(f"Dumped {len(all_chunks)} chunks to {output_file}")
@@ -2,15 +2,51 @@
 import sqlite3
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 import json
+import threading
 
 DATABASE_FILE = Path("bus_bookings.db")
 
+# One connection per worker thread, reused across requests
+_local = threading.local()
+
+# Hot-path SQL kept as constants so the statement cache key stays identical
+
+# booking_id is derived from the AUTOINCREMENT sequence inside the INSERT
+# itself, so it matches the new row's id and never needs a COUNT(*) scan
+SQL_INSERT_BOOKING = """
+    INSERT INTO bookings (
+        booking_id, name, phone, bus_provider, from_district, to_district,
+        dropping_point, travel_date, num_passengers, fare, total_amount, booking_date, status
+    ) VALUES (
+        printf('BK%05d', COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'bookings'), 0) + 1),
+        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    )
+"""
+SQL_GET_BY_PHONE = "SELECT * FROM bookings WHERE phone = ? ORDER BY created_at DESC"
+SQL_GET_ACTIVE_BY_PHONE = """
+    SELECT booking_id, from_district, to_district, travel_date
+    FROM bookings
+    WHERE phone = ? AND status = 'active'
+    ORDER BY created_at DESC
+"""
+SQL_GET_BY_ID = "SELECT * FROM bookings WHERE booking_id = ?"
+SQL_INSERT_CHAT = """
+    INSERT INTO chat_history (session_id, phone, role, message)
+    VALUES (?, ?, ?, ?)
+"""
+
 def get_db_connection():
-    """Create database connection"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+    """Get the cached database connection for the current thread"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_FILE, cached_statements=256)
+        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        _local.conn = conn
     return conn
 
 def init_database():
@@ -18,6 +54,9 @@ def init_database():
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    # WAL mode is persistent on the database file, so set it once here
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Bookings table
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS bookings (
@@ -63,8 +102,12 @@ def init_database():
         )
     """)
     
+    # Indexes for phone/status lookups and per-session chat history
+    # (booking_id is already indexed by its UNIQUE constraint)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bookings_phone_status ON bookings(phone, status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_session_ts ON chat_history(session_id, timestamp)")
+    
     conn.commit()
-    conn.close()
     print("✅ Database initialized")
 
 # Initialize database on import
@@ -73,34 +116,27 @@ init_database()
 # ==================== Booking Operations ====================
 
 def create_booking(booking_data: dict) -> dict:
-    """Create a new booking"""
+    """Create a new booking and assign its booking ID"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("""
-        INSERT INTO bookings (
-            booking_id, name, phone, bus_provider, from_district, to_district,
-            dropping_point, travel_date, num_passengers, fare, total_amount, booking_date, status
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        booking_data['booking_id'],
-        booking_data['name'],
-        booking_data['phone'],
-        booking_data['bus_provider'],
-        booking_data['from_district'],
-        booking_data['to_district'],
-        booking_data['dropping_point'],
-        booking_data['travel_date'],
-        booking_data['num_passengers'],
-        booking_data['fare'],
-        booking_data['total_amount'],
-        booking_data['booking_date'],
-        'active'
-    ))
-    
-    conn.commit()
-    conn.close()
-    
+    with conn:  # commit on success, roll back on error
+        cursor.execute(SQL_INSERT_BOOKING, (
+            booking_data['name'],
+            booking_data['phone'],
+            booking_data['bus_provider'],
+            booking_data['from_district'],
+            booking_data['to_district'],
+            booking_data['dropping_point'],
+            booking_data['travel_date'],
+            booking_data['num_passengers'],
+            booking_data['fare'],
+            booking_data['total_amount'],
+            booking_data['booking_date'],
+            'active'
+        ))
+    
+    booking_data['booking_id'] = f"BK{cursor.lastrowid:05d}"
     return booking_data
 
 def get_all_bookings() -> List[dict]:
@@ -111,18 +147,38 @@ def get_all_bookings() -> List[dict]:
     cursor.execute("SELECT * FROM bookings ORDER BY created_at DESC")
     bookings = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
     return bookings
 
+def get_all_booking_rows() -> Tuple[List[str], List[tuple]]:
+    """Get all bookings as (column names, plain tuples) for bulk serialization"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = None  # Skip sqlite3.Row construction per row
+    
+    cursor.execute("SELECT * FROM bookings ORDER BY created_at DESC")
+    columns = [col[0] for col in cursor.description]
+    rows = cursor.fetchall()
+    
+    return columns, rows
+
 def get_bookings_by_phone(phone: str) -> List[dict]:
     """Get bookings by phone number"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT * FROM bookings WHERE phone = ? ORDER BY created_at DESC", (phone,))
+    cursor.execute(SQL_GET_BY_PHONE, (phone,))
+    bookings = [dict(row) for row in cursor.fetchall()]
+    
+    return bookings
+
+def get_active_bookings_by_phone(phone: str) -> List[dict]:
+    """Get active bookings by phone number (only the columns needed to cancel)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute(SQL_GET_ACTIVE_BY_PHONE, (phone,))
     bookings = [dict(row) for row in cursor.fetchall()]
     
-    conn.close()
     return bookings
 
 def get_booking_by_id(booking_id: str) -> Optional[dict]:
@@ -130,10 +186,9 @@ def get_booking_by_id(booking_id: str) -> Optional[dict]:
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("SELECT * FROM bookings WHERE booking_id = ?", (booking_id,))
+    cursor.execute(SQL_GET_BY_ID, (booking_id,))
     row = cursor.fetchone()
     
-    conn.close()
     return dict(row) if row else None
 
 def delete_booking_permanently(booking_id: str) -> bool:
@@ -141,26 +196,23 @@ def delete_booking_permanently(booking_id: str) -> bool:
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Get booking data first
-    cursor.execute("SELECT * FROM bookings WHERE booking_id = ?", (booking_id,))
-    booking = cursor.fetchone()
-    
-    if not booking:
-        conn.close()
-        return False
-    
-    # Save to deleted bookings history
-    booking_data = dict(booking)
-    cursor.execute("""
-        INSERT INTO deleted_bookings (booking_id, booking_data, deleted_by_phone)
-        VALUES (?, ?, ?)
-    """, (booking_id, json.dumps(booking_data), booking_data.get('phone')))
-    
-    # Delete from bookings table
-    cursor.execute("DELETE FROM bookings WHERE booking_id = ?", (booking_id,))
-    
-    conn.commit()
-    conn.close()
+    with conn:
+        # Get booking data first
+        cursor.execute(SQL_GET_BY_ID, (booking_id,))
+        booking = cursor.fetchone()
+        
+        if not booking:
+            return False
+        
+        # Save to deleted bookings history
+        booking_data = dict(booking)
+        cursor.execute("""
+            INSERT INTO deleted_bookings (booking_id, booking_data, deleted_by_phone)
+            VALUES (?, ?, ?)
+        """, (booking_id, json.dumps(booking_data), booking_data.get('phone')))
+        
+        # Delete from bookings table
+        cursor.execute("DELETE FROM bookings WHERE booking_id = ?", (booking_id,))
     
     return True
 
@@ -169,29 +221,17 @@ def cancel_booking(booking_id: str) -> bool:
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("""
-        UPDATE bookings 
-        SET status = 'cancelled', cancelled_date = ?
-        WHERE booking_id = ? AND status = 'active'
-    """, (datetime.now().isoformat(), booking_id))
+    with conn:
+        cursor.execute("""
+            UPDATE bookings 
+            SET status = 'cancelled', cancelled_date = ?
+            WHERE booking_id = ? AND status = 'active'
+        """, (datetime.now().isoformat(), booking_id))
     
     rows_affected = cursor.rowcount
-    conn.commit()
-    conn.close()
     
     return rows_affected > 0
 
-def generate_booking_id() -> str:
-    """Generate unique booking ID"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT COUNT(*) as count FROM bookings")
-    count = cursor.fetchone()['count']
-    
-    conn.close()
-    return f"BK{count + 1:05d}"
-
 # ==================== Chat History Operations ====================
 
 def save_chat_message(session_id: str, role: str, message: str, phone: str = None):
@@ -199,13 +239,20 @@ def save_chat_message(session_id: str, role: str, message: str, phone: str = Non
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("""
-        INSERT INTO chat_history (session_id, phone, role, message)
-        VALUES (?, ?, ?, ?)
-    """, (session_id, phone, role, message))
+    with conn:
+        cursor.execute(SQL_INSERT_CHAT, (session_id, phone, role, message))
+
+def save_chat_exchange(session_id: str, user_message: str, user_phone: Optional[str],
+                       assistant_message: str, assistant_phone: Optional[str]):
+    """Save a user message and the assistant reply in one transaction"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
     
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.executemany(SQL_INSERT_CHAT, [
+            (session_id, user_phone, "user", user_message),
+            (session_id, assistant_phone, "assistant", assistant_message)
+        ])
 
 def get_chat_history(session_id: str, limit: int = 10) -> List[dict]:
     """Get chat history for a session"""
@@ -216,14 +263,13 @@ def get_chat_history(session_id: str, limit: int = 10) -> List[dict]:
         SELECT role, message, timestamp 
         FROM chat_history 
         WHERE session_id = ?
-        ORDER BY timestamp DESC
+        ORDER BY timestamp DESC, id DESC
         LIMIT ?
     """, (session_id, limit))
     
     history = [dict(row) for row in cursor.fetchall()]
     history.reverse()  # Oldest first
     
-    conn.close()
     return history
 
 def clear_chat_history(session_id: str):
@@ -231,10 +277,8 @@ def clear_chat_history(session_id: str):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute("DELETE FROM chat_history WHERE session_id = ?", (session_id,))
-    
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("DELETE FROM chat_history WHERE session_id = ?", (session_id,))
 
 # ==================== Statistics ====================
 
@@ -243,21 +287,20 @@ def get_booking_statistics() -> dict:
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Total bookings
-    cursor.execute("SELECT COUNT(*) as count FROM bookings")
-    total = cursor.fetchone()['count']
-    
-    # Active bookings
-    cursor.execute("SELECT COUNT(*) as count FROM bookings WHERE status = 'active'")
-    active = cursor.fetchone()['count']
-    
-    # Cancelled bookings
-    cursor.execute("SELECT COUNT(*) as count FROM bookings WHERE status = 'cancelled'")
-    cancelled = cursor.fetchone()['count']
-    
-    # Total revenue (active only)
-    cursor.execute("SELECT SUM(total_amount) as revenue FROM bookings WHERE status = 'active'")
-    revenue = cursor.fetchone()['revenue'] or 0
+    # Totals, active/cancelled counts and revenue (active only) in one scan
+    cursor.execute("""
+        SELECT
+            COUNT(*) as total,
+            COUNT(CASE WHEN status = 'active' THEN 1 END) as active,
+            COUNT(CASE WHEN status = 'cancelled' THEN 1 END) as cancelled,
+            SUM(CASE WHEN status = 'active' THEN total_amount END) as revenue
+        FROM bookings
+    """)
+    totals = cursor.fetchone()
+    total = totals['total']
+    active = totals['active']
+    cancelled = totals['cancelled']
+    revenue = totals['revenue'] or 0
     
     # Provider statistics
     cursor.execute("""
@@ -274,8 +317,6 @@ def get_booking_statistics() -> dict:
             'revenue': row['revenue']
         }
     
-    conn.close()
-    
     return {
         'total_bookings': total,
         'active_bookings': active,
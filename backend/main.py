@@ -1,21 +1,31 @@
 # backend/main.py
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
-import json
 from pathlib import Path
-import uuid
+import re
+import secrets
+import asyncio
+import orjson
+import threading
+from cachetools import TTLCache
+from markupsafe import Markup
 
 from .database import (
-    create_booking, get_all_bookings, get_bookings_by_phone,
+    create_booking, get_all_booking_rows, get_bookings_by_phone, get_active_bookings_by_phone,
     get_booking_by_id, cancel_booking, delete_booking_permanently,
-    generate_booking_id, get_booking_statistics, save_chat_message, get_chat_history
+    get_booking_statistics, save_chat_exchange, get_chat_history
+)
+from .data_loader import bus_data  # parsed once, shared with the RAG pipeline
+from .rag_pipeline import (
+    aget_answer, astream_answer, get_answer_with_sources, detect_provider_from_query, detect_query_type,
+    is_follow_up
 )
-from .rag_pipeline import get_answer, get_answer_with_sources
 
 app = FastAPI(title="Bus Ticket Booking System")
 
@@ -33,11 +43,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load bus data
-DATA_FILE = BASE_DIR / "data.json"
-with open(DATA_FILE, "r", encoding="utf-8") as f:
-    bus_data = json.load(f)
-
 # ==================== Models ====================
 
 class BookingCreate(BaseModel):
@@ -69,112 +74,201 @@ class QueryRequest(BaseModel):
     query: str
     phone: Optional[str] = None
     session_id: Optional[str] = None
+    stream: bool = False   # stream RAG answers as plain text chunks
+
+# ==================== Lookup Indexes ====================
+# Built once at import with lowercased keys so helpers avoid per-request scans
+
+_district_by_name = {d["name"].lower(): d for d in bus_data["districts"]}
+
+_dp_price = {
+    (d["name"].lower(), dp["name"].lower()): dp["price"]
+    for d in bus_data["districts"]
+    for dp in d["dropping_points"]
+}
+
+def price_range(dropping_points: list) -> tuple:
+    """(lowest, highest) fare in one pass over the dropping points"""
+    low = high = dropping_points[0]["price"]
+    for dp in dropping_points:
+        price = dp["price"]
+        if price < low:
+            low = price
+        elif price > high:
+            high = price
+    return low, high
+
+# Fare range per district name for the Routes & Fares cards
+_district_price_range = {
+    d["name"]: price_range(d["dropping_points"])
+    for d in bus_data["districts"]
+    if d["dropping_points"]
+}
+
+# Kept beside bus_data rather than on it, so /providers output is unchanged
+_provider_coverage = {
+    p["name"].lower(): frozenset(d.lower() for d in p["coverage_districts"])
+    for p in bus_data["bus_providers"]
+}
+
+# Policy files are small and static, so read them once at startup
+POLICY_FILES = {
+    "desh travel": "desh_travel.txt",
+    "ena": "ena.txt",
+    "green line": "green line.txt",
+    "greenline": "green line.txt",
+    "hanif": "hanif.txt",
+    "shyamoli": "shyamoli.txt",
+    "soudia": "soudia.txt"
+}
+
+def _read_policy(file_name: str) -> Optional[str]:
+    try:
+        return (BASE_DIR / "attachment" / file_name).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+_policy_cache = {name: _read_policy(file_name) for name, file_name in POLICY_FILES.items()}
 
 # ==================== Helper Functions ====================
 
 def get_fare(district: str, dropping_point: str) -> int:
-    for dist in bus_data["districts"]:
-        if dist["name"].lower() == district.lower():
-            for dp in dist["dropping_points"]:
-                if dp["name"].lower() == dropping_point.lower():
-                    return dp["price"]
-    return 0
+    return _dp_price.get((district.lower(), dropping_point.lower()), 0)
 
 def validate_route(provider: str, from_district: str, to_district: str) -> bool:
-    for p in bus_data["bus_providers"]:
-        if p["name"].lower() == provider.lower():
-            coverage_lower = [d.lower() for d in p["coverage_districts"]]
-            return from_district.lower() in coverage_lower and to_district.lower() in coverage_lower
-    return False
+    coverage = _provider_coverage.get(provider.lower())
+    if coverage is None:
+        return False
+    return coverage.issuperset((from_district.lower(), to_district.lower()))
+
+# Pasted numbers like "+88 017-1234 5678" reduce to the local 01XXXXXXXXX form
+PHONE_SEPARATORS = re.compile(r"[\s\-()]")
+PHONE_COUNTRY_PREFIX = re.compile(r"^\+?88(?=01)")
+
+def normalize_phone(phone: str) -> str:
+    return PHONE_COUNTRY_PREFIX.sub("", PHONE_SEPARATORS.sub("", phone))
 
 def get_available_providers(from_district: str, to_district: str) -> List[str]:
+    from_lower, to_lower = from_district.lower(), to_district.lower()
     available = []
     for provider in bus_data["bus_providers"]:
-        coverage_lower = [d.lower() for d in provider["coverage_districts"]]
-        if from_district.lower() in coverage_lower and to_district.lower() in coverage_lower:
+        coverage = _provider_coverage[provider["name"].lower()]
+        if from_lower in coverage and to_lower in coverage:
             available.append(provider["name"])
     return available
 
 def get_dropping_points_by_district(district: str):
-    for d in bus_data["districts"]:
-        if d["name"].lower() == district.lower():
-            return [{"name": dp["name"], "price": dp["price"]} for dp in d["dropping_points"]]
-    return []
+    d = _district_by_name.get(district.lower())
+    if d is None:
+        return []
+    return [{"name": dp["name"], "price": dp["price"]} for dp in d["dropping_points"]]
 
 # ==================== Session Storage ====================
-sessions = {}
+# Bounded and time-limited so abandoned chat sessions are evicted
+SESSION_MAX = 10_000
+SESSION_TTL_SECONDS = 3600
+
+sessions = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL_SECONDS)
+_sessions_lock = threading.Lock()
+
+def new_session_state() -> dict:
+    return {
+        "awaiting_booking_id": False,
+        "awaiting_phone_for_cancel": False,
+        "pending_bookings": [],
+        "phone": None,
+        "provider": None   # last provider asked about, for follow-up questions
+    }
+
+def get_session(session_id: str) -> dict:
+    """Return the session state, creating it if missing or expired"""
+    with _sessions_lock:
+        session = sessions.get(session_id) or new_session_state()
+        # Re-inserting refreshes the TTL, so only idle sessions expire
+        sessions[session_id] = session
+        return session
 
 # ==================== Page Routes (HTML) ====================
 
+def _htmlsafe_json(obj) -> Markup:
+    """JSON for embedding in a <script> tag (same escaping as Jinja's tojson)."""
+    text = orjson.dumps(obj).decode()
+    for char, escaped in (("<", "\\u003c"), (">", "\\u003e"), ("&", "\\u0026"), ("'", "\\u0027")):
+        text = text.replace(char, escaped)
+    return Markup(text)
+
+# Name-keyed lookups for the booking page, serialized once
+_BOOKING_LOOKUP_JSON = _htmlsafe_json({
+    "coverage": {p["name"]: p["coverage_districts"] for p in bus_data["bus_providers"]},
+    "droppingPoints": {d["name"]: d["dropping_points"] for d in bus_data["districts"]}
+})
+
+# Every page depends only on static data (JS fetches the rest), so each
+# one is rendered once and the HTML reused for later requests
+_page_cache = {}
+
+def render_static_page(template_name: str, **context) -> HTMLResponse:
+    """Render a template on first use and serve the cached HTML afterwards."""
+    html = _page_cache.get(template_name)
+    if html is None:
+        html = templates.get_template(template_name).render(**context)
+        _page_cache[template_name] = html
+    return HTMLResponse(html)
+
 @app.get("/")
-def index(request: Request):
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "active": "book",
-        "providers": bus_data["bus_providers"],
-        "districts": bus_data["districts"]
-    })
+def index():
+    return render_static_page(
+        "index.html",
+        active="book",
+        providers=bus_data["bus_providers"],
+        districts=bus_data["districts"],
+        booking_lookup=_BOOKING_LOOKUP_JSON
+    )
 
 @app.get("/bookings-page")
-def bookings_page(request: Request):
-    return templates.TemplateResponse("bookings.html", {
-        "request": request,
-        "active": "bookings"
-    })
+def bookings_page():
+    return render_static_page("bookings.html", active="bookings")
 
 @app.get("/providers-page")
-def providers_page(request: Request):
-    return templates.TemplateResponse("providers.html", {
-        "request": request,
-        "active": "providers",
-        "providers": bus_data["bus_providers"]
-    })
+def providers_page():
+    return render_static_page("providers.html", active="providers", providers=bus_data["bus_providers"])
 
 @app.get("/routes-page")
-def routes_page(request: Request):
-    return templates.TemplateResponse("routes.html", {
-        "request": request,
-        "active": "routes",
-        "districts": bus_data["districts"]
-    })
+def routes_page():
+    return render_static_page(
+        "routes.html",
+        active="routes",
+        districts=bus_data["districts"],
+        price_ranges=_district_price_range
+    )
 
 @app.get("/assistant-page")
-def assistant_page(request: Request):
-    return templates.TemplateResponse("assistant.html", {
-        "request": request,
-        "active": "assistant"
-    })
+def assistant_page():
+    return render_static_page("assistant.html", active="assistant")
 
 # ==================== API Endpoints ====================
 
+# Reference data never changes while the process runs: serialize it once
+# and let browsers cache it for a few minutes
+REFERENCE_CACHE_HEADERS = {"Cache-Control": "public, max-age=300"}
+_DISTRICTS_JSON = orjson.dumps({"districts": bus_data["districts"]})
+_PROVIDERS_JSON = orjson.dumps({"providers": bus_data["bus_providers"]})
+
 @app.get("/districts")
 def get_districts():
-    return {"districts": bus_data["districts"]}
+    return Response(_DISTRICTS_JSON, media_type="application/json", headers=REFERENCE_CACHE_HEADERS)
 
 @app.get("/providers")
 def get_providers():
-    return {"providers": bus_data["bus_providers"]}
+    return Response(_PROVIDERS_JSON, media_type="application/json", headers=REFERENCE_CACHE_HEADERS)
 
 @app.get("/providers/{provider_name}/policy")
 def get_provider_policy(provider_name: str):
-    provider_map = {
-        "desh travel": "desh_travel.txt",
-        "ena": "ena.txt",
-        "green line": "green line.txt",
-        "greenline": "green line.txt",
-        "hanif": "hanif.txt",
-        "shyamoli": "shyamoli.txt",
-        "soudia": "soudia.txt"
-    }
     normalized = provider_name.lower().strip()
-    if normalized not in provider_map:
+    if normalized not in POLICY_FILES:
         raise HTTPException(status_code=404, detail="Policy not available for this provider")
-    file_name = provider_map[normalized]
-    file_path = BASE_DIR / "attachment" / file_name
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-    except FileNotFoundError:
+    content = _policy_cache[normalized]
+    if content is None:
         raise HTTPException(status_code=404, detail="Policy file not found")
     return {"provider": provider_name, "policy": content}
 
@@ -186,16 +280,16 @@ def available_providers(from_district: str, to_district: str):
     return {"providers": providers}
 
 @app.get("/dropping-points/{district}")
-def dropping_points(district: str):
+def dropping_points(district: str, response: Response) -> dict:
     points = get_dropping_points_by_district(district)
     if not points:
         return {"message": f"No dropping points found for {district}", "dropping_points": []}
+    response.headers.update(REFERENCE_CACHE_HEADERS)
     return {"dropping_points": points}
 
 @app.post("/bookings", response_model=BookingResponse)
-def create_booking_endpoint(booking: BookingCreate):
-    provider_exists = any(p["name"].lower() == booking.bus_provider.lower() for p in bus_data["bus_providers"])
-    if not provider_exists:
+async def create_booking_endpoint(booking: BookingCreate):
+    if booking.bus_provider.lower() not in _provider_coverage:
         raise HTTPException(status_code=400, detail=f"Bus provider '{booking.bus_provider}' not found")
     if not validate_route(booking.bus_provider, booking.from_district, booking.to_district):
         raise HTTPException(status_code=400, detail=f"{booking.bus_provider} does not operate on this route")
@@ -203,7 +297,6 @@ def create_booking_endpoint(booking: BookingCreate):
     if fare == 0:
         raise HTTPException(status_code=400, detail=f"Dropping point '{booking.dropping_point}' not found in {booking.to_district}")
     new_booking_data = {
-        "booking_id": generate_booking_id(),
         "name": booking.name,
         "phone": booking.phone.strip(),
         "bus_provider": booking.bus_provider,
@@ -217,72 +310,79 @@ def create_booking_endpoint(booking: BookingCreate):
         "booking_date": datetime.now().isoformat(),
         "status": "active"
     }
-    saved_booking = create_booking(new_booking_data)
+    saved_booking = await asyncio.to_thread(create_booking, new_booking_data)
     return saved_booking
 
 @app.get("/bookings")
-def list_all_bookings():
-    return {"bookings": get_all_bookings()}
+async def list_all_bookings():
+    columns, rows = await asyncio.to_thread(get_all_booking_rows)
+
+    def encode(batch_size: int = 500):
+        # Stream the JSON array in batches instead of building one large payload
+        yield b'{"bookings":['
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            prefix = b"," if start else b""
+            yield prefix + b",".join(orjson.dumps(dict(zip(columns, row))) for row in batch)
+        yield b"]}"
+
+    return StreamingResponse(encode(), media_type="application/json")
 
 @app.get("/bookings/phone/{phone}")
-def bookings_by_phone(phone: str):
-    bookings = get_bookings_by_phone(phone.strip())
+async def bookings_by_phone(phone: str) -> dict:
+    bookings = await asyncio.to_thread(get_bookings_by_phone, phone.strip())
     if not bookings:
         raise HTTPException(status_code=404, detail="No bookings found for this phone number")
     return {"bookings": bookings}
 
 @app.get("/bookings/{booking_id}")
-def booking_details(booking_id: str):
-    booking = get_booking_by_id(booking_id)
+async def booking_details(booking_id: str) -> dict:
+    booking = await asyncio.to_thread(get_booking_by_id, booking_id)
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found")
     return booking
 
 @app.delete("/bookings/{booking_id}")
-def delete_booking_endpoint(booking_id: str, permanent: Optional[bool] = False):
+async def delete_booking_endpoint(booking_id: str, permanent: Optional[bool] = False):
     if permanent:
-        success = delete_booking_permanently(booking_id)
+        success = await asyncio.to_thread(delete_booking_permanently, booking_id)
         if success:
             return {"message": f"Booking {booking_id} deleted permanently."}
         raise HTTPException(status_code=404, detail="Booking not found")
     else:
-        success = cancel_booking(booking_id)
+        success = await asyncio.to_thread(cancel_booking, booking_id)
         if success:
             return {"message": f"Booking {booking_id} cancelled."}
         raise HTTPException(status_code=404, detail="Booking not found")
 
+async def stream_and_save_answer(session_id: str, request: QueryRequest, provider: str, session: dict):
+    """Relay streamed answer text, then store the full exchange"""
+    parts = []
+    async for chunk in astream_answer(request.query, provider):
+        parts.append(chunk)
+        yield chunk
+    await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, "".join(parts), session.get("phone"))
+
 @app.post("/query/smart")
-def query_smart(request: QueryRequest):
-    session_id = request.session_id or str(uuid.uuid4())
-    if session_id not in sessions:
-        sessions[session_id] = {
-            "awaiting_booking_id": False,
-            "awaiting_phone_for_cancel": False,
-            "pending_bookings": [],
-            "phone": None
-        }
-    session = sessions[session_id]
+async def query_smart(request: QueryRequest):
+    session_id = request.session_id or secrets.token_hex(8)
+    session = get_session(session_id)
     query_text = request.query.strip()
     query_lower = query_text.lower()
 
-    save_chat_message(session_id, "user", request.query, request.phone)
-
     if session.get("awaiting_phone_for_cancel"):
-        phone = query_text
-        if phone.startswith("+88"):
-            phone = phone[3:]
+        phone = normalize_phone(query_text)
         session["phone"] = phone
         session["awaiting_phone_for_cancel"] = False
-        bookings = get_bookings_by_phone(phone)
-        active_bookings = [b for b in bookings if b['status'] == 'active']
+        active_bookings = await asyncio.to_thread(get_active_bookings_by_phone, phone)
         if not active_bookings:
             message = f"No active bookings found for phone number {phone}"
-            save_chat_message(session_id, "assistant", message, phone)
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, phone)
             return {"message": message, "session_id": session_id}
         if len(active_bookings) == 1:
-            cancel_booking(active_bookings[0]['booking_id'])
+            await asyncio.to_thread(cancel_booking, active_bookings[0]['booking_id'])
             message = f"Booking {active_bookings[0]['booking_id']} has been cancelled successfully."
-            save_chat_message(session_id, "assistant", message, phone)
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, phone)
             return {"message": message, "session_id": session_id}
         session["awaiting_booking_id"] = True
         session["pending_bookings"] = active_bookings
@@ -290,22 +390,22 @@ def query_smart(request: QueryRequest):
         for b in active_bookings:
             message += f"{b['from_district']} to {b['to_district']} on {b['travel_date']} (ID: {b['booking_id']})\n"
         message += "\nPlease provide the Booking ID you want to cancel."
-        save_chat_message(session_id, "assistant", message, phone)
+        await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, phone)
         return {"message": message, "session_id": session_id}
 
     if session["awaiting_booking_id"]:
         booking_id = query_text
         booking = next((b for b in session["pending_bookings"] if b["booking_id"] == booking_id), None)
         if booking:
-            cancel_booking(booking_id)
+            await asyncio.to_thread(cancel_booking, booking_id)
             session["awaiting_booking_id"] = False
             session["pending_bookings"] = []
             message = f"Booking {booking_id} has been cancelled successfully."
-            save_chat_message(session_id, "assistant", message, session.get("phone"))
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, session.get("phone"))
             return {"message": message, "session_id": session_id}
         else:
             message = f"Booking ID {booking_id} not found. Please check again."
-            save_chat_message(session_id, "assistant", message, session.get("phone"))
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, session.get("phone"))
             return {"message": message, "session_id": session_id}
 
     if any(k in query_lower for k in ["cancel", "cancellation"]):
@@ -313,21 +413,19 @@ def query_smart(request: QueryRequest):
         if not phone:
             session["awaiting_phone_for_cancel"] = True
             message = "To cancel your booking, please provide your phone number."
-            save_chat_message(session_id, "assistant", message, None)
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, None)
             return {"message": message, "session_id": session_id}
-        if phone.startswith("+88"):
-            phone = phone[3:]
+        phone = normalize_phone(phone)
         session["phone"] = phone
-        bookings = get_bookings_by_phone(phone)
-        active_bookings = [b for b in bookings if b['status'] == 'active']
+        active_bookings = await asyncio.to_thread(get_active_bookings_by_phone, phone)
         if not active_bookings:
             message = f"No active bookings found for phone number {phone}"
-            save_chat_message(session_id, "assistant", message, phone)
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, phone)
             return {"message": message, "session_id": session_id}
         if len(active_bookings) == 1:
-            cancel_booking(active_bookings[0]['booking_id'])
+            await asyncio.to_thread(cancel_booking, active_bookings[0]['booking_id'])
             message = f"Booking {active_bookings[0]['booking_id']} has been cancelled successfully."
-            save_chat_message(session_id, "assistant", message, phone)
+            await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, phone)
             return {"message": message, "session_id": session_id}
         session["awaiting_booking_id"] = True
         session["pending_bookings"] = active_bookings
@@ -335,31 +433,50 @@ def query_smart(request: QueryRequest):
         for b in active_bookings:
             message += f"{b['from_district']} to {b['to_district']} on {b['travel_date']} (ID: {b['booking_id']})\n"
         message += "\nPlease provide the Booking ID you want to cancel."
-        save_chat_message(session_id, "assistant", message, phone)
+        await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, message, phone)
         return {"message": message, "session_id": session_id}
 
-    answer = get_answer(request.query)
-    save_chat_message(session_id, "assistant", answer, session.get("phone"))
+    # Follow-ups like "and their refund policy?" keep the session's provider.
+    # Only provider-scoped query types that read as follow-ups inherit it:
+    # fare chunks carry no provider metadata, and broad questions ("all
+    # providers") must not be narrowed to the last provider discussed.
+    provider = detect_provider_from_query(request.query)
+    if provider:
+        session["provider"] = provider
+    elif detect_query_type(request.query) in ("policy", "provider") and is_follow_up(request.query):
+        provider = session.get("provider")
+
+    # Streamed answers carry the session id in a header, since the body is plain text
+    if request.stream:
+        return StreamingResponse(
+            stream_and_save_answer(session_id, request, provider, session),
+            media_type="text/plain; charset=utf-8",
+            headers={"X-Session-Id": session_id}
+        )
+
+    answer = await aget_answer(request.query, provider)
+    await asyncio.to_thread(save_chat_exchange, session_id, request.query, request.phone, answer, session.get("phone"))
     return {"message": answer, "session_id": session_id}
 
 @app.post("/query/detailed")
-def query_rag_with_sources(request: QueryRequest):
-    return get_answer_with_sources(request.query)
+async def query_rag_with_sources(request: QueryRequest):
+    return await asyncio.to_thread(get_answer_with_sources, request.query)
 
 @app.post("/chat/clear")
 def clear_chat(session_id: str):
-    if session_id in sessions:
-        sessions[session_id] = {
-            "awaiting_booking_id": False,
-            "awaiting_phone_for_cancel": False,
-            "pending_bookings": [],
-            "phone": None
-        }
+    with _sessions_lock:
+        if session_id in sessions:
+            sessions[session_id] = new_session_state()
     return {"message": "Chat cleared"}
 
+# Liveness only, so the status dot never waits on the database
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
 @app.get("/stats")
-def stats():
-    return get_booking_statistics()
+async def stats() -> dict:
+    return await asyncio.to_thread(get_booking_statistics)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,71 @@
+# backend/onnx_embeddings.py
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+ONNX_MODEL_DIR = Path("minilm_int8")
+ONNX_FILE_NAME = "model_quantized.onnx"
+
+
+def export_quantized_model(model_name: str, model_dir: Path = ONNX_MODEL_DIR):
+    """Export the model to ONNX and apply dynamic int8 quantization."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    print(f"Exporting {model_name} to int8 ONNX in {model_dir}...")
+    onnx_model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    quantizer = ORTQuantizer.from_pretrained(onnx_model)
+    quantizer.quantize(
+        save_dir=model_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+
+class ORTEmbeddings(Embeddings):
+    """
+    LangChain embeddings backed by an int8 ONNX Runtime export of a
+    sentence-transformers model. Mirrors the MiniLM pipeline:
+    mean pooling over the attention mask followed by L2 normalization.
+    """
+
+    def __init__(self, model_name: str, model_dir: Path = ONNX_MODEL_DIR,
+                 batch_size: int = 64, max_length: int = 256):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if not (model_dir / ONNX_FILE_NAME).exists():
+            export_quantized_model(model_name, model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=ONNX_FILE_NAME)
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            inputs = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            hidden = self.model(**inputs).last_hidden_state
+
+            mask = inputs["attention_mask"][..., None].astype(hidden.dtype)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.tolist())
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
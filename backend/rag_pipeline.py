@@ -3,10 +3,19 @@ from langchain_chroma import Chroma
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
-from .data_loader import all_chunks, providers as raw_providers
+from .data_loader import (
+    build_chunks, source_fingerprint, providers as raw_providers, districts as raw_districts, EMBEDDING_MODEL_NAME
+)
 import re
 import os
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
+import torch
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,49 +26,61 @@ os.environ["GOOGLE_API_KEY"] = os.environ.get("GOOGLE_API_KEY", "")
 # ======================================================
 #          Embeddings & Vector DB
 # ======================================================
-embedding_model = HuggingFaceEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L6-v2"
-)
+# Opt-in int8 ONNX Runtime embeddings for CPU hosts (needs optimum[onnxruntime])
+USE_ONNX_EMBEDDINGS = os.environ.get("USE_ONNX_EMBEDDINGS", "0") == "1" and not torch.cuda.is_available()
+
+if USE_ONNX_EMBEDDINGS:
+    from .onnx_embeddings import ORTEmbeddings
+    embedding_model = ORTEmbeddings(model_name=EMBEDDING_MODEL_NAME, batch_size=64)
+else:
+    # Encode in batches of 64; on GPU load the weights in FP16
+    if torch.cuda.is_available():
+        embedding_model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+    else:
+        embedding_model_kwargs = {"device": "cpu"}
+
+    embedding_model = HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs=embedding_model_kwargs,
+        encode_kwargs={
+            "batch_size": 64,
+            "normalize_embeddings": True,
+            "convert_to_numpy": True
+        }
+    )
 
+# Quantized vectors get their own collection so they never mix with FP32 ones
 vectordb = Chroma(
-    collection_name="bus_data",
+    collection_name="bus_data_int8" if USE_ONNX_EMBEDDINGS else "bus_data",
     embedding_function=embedding_model,
     persist_directory="vectorstore"
 )
 
 
 # ======================================================
-#          Metadata Cleaner
+#          Load Chunks into Vector DB (only when inputs change)
 # ======================================================
-def clean_metadata(metadata: dict) -> dict:
-    """Convert list values to comma-separated strings for Chroma compatibility."""
-    cleaned = {}
-    for key, value in metadata.items():
-        if isinstance(value, list):
-            cleaned[key] = ", ".join(str(v) for v in value)
-        elif isinstance(value, int) or isinstance(value, float):
-            cleaned[key] = value          # keep numbers as numbers for filtering
-        else:
-            cleaned[key] = value
-    return cleaned
-
-
-# ======================================================
-#          Load Chunks into Vector DB (once)
-# ======================================================
-if len(vectordb.get()["ids"]) == 0:
+# The fingerprint of data.json + policy files is kept in the collection
+# metadata, so chunks are rebuilt and re-embedded only when it differs
+fingerprint = source_fingerprint()
+stored_fingerprint = (vectordb._collection.metadata or {}).get("source_fingerprint")
+existing_count = vectordb._collection.count()
+
+if existing_count == 0 or stored_fingerprint != fingerprint:
+    if existing_count:
+        print("Source data changed, rebuilding vector DB...")
+        vectordb.reset_collection()
+    all_chunks = build_chunks()
     print("Adding chunks to vector DB...")
-    for chunk in all_chunks:
-        metadata = chunk["metadata"].copy()
-        if "provider" in metadata and metadata["provider"]:
-            metadata["provider"] = metadata["provider"].strip().lower()
-        vectordb.add_texts(
-            [chunk["content"]],
-            metadatas=[clean_metadata(metadata)]
-        )
+    # Single call: one batched embedding pass and one Chroma write
+    vectordb.add_texts(
+        [chunk["content"] for chunk in all_chunks],
+        metadatas=[chunk["metadata"] for chunk in all_chunks]
+    )
+    vectordb._collection.modify(metadata={"source_fingerprint": fingerprint})
     print(f"✅ Added {len(all_chunks)} chunks.")
 else:
-    print(f"ℹ️ Vector DB already has {len(vectordb.get()['ids'])} chunks.")
+    print(f"ℹ️ Vector DB already has {existing_count} chunks.")
 
 
 # ======================================================
@@ -97,6 +118,9 @@ PROMPT = PromptTemplate(
     input_variables=["context", "question"]
 )
 
+# Prompt -> LLM -> text; fed the retrieved context and question by every answer path
+answer_chain = PROMPT | gemini_llm | StrOutputParser()
+
 
 # ======================================================
 #          Query Understanding Helpers
@@ -105,14 +129,35 @@ PROMPT = PromptTemplate(
 # Build known provider list dynamically from data
 KNOWN_PROVIDERS = [p["name"].lower() for p in raw_providers]
 
+# One compiled alternation instead of a substring scan per provider.
+# Longest names first so multi-word names win over any shorter prefix.
+PROVIDER_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(p) for p in sorted(KNOWN_PROVIDERS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+
+
+# District and dropping point names, so e.g. fares for two stops in the
+# same district are never treated as the same question
+KNOWN_PLACES = {d["name"].lower() for d in raw_districts} | {
+    dp["name"].lower() for d in raw_districts for dp in d["dropping_points"]
+}
+
+PLACE_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(p) for p in sorted(KNOWN_PLACES, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+
 
 def detect_provider_from_query(query: str) -> str | None:
     """Detect if user is asking about a specific bus provider."""
-    query_lower = query.lower()
-    for provider in KNOWN_PROVIDERS:
-        if provider in query_lower:
-            return provider
-    return None
+    match = PROVIDER_PATTERN.search(query)
+    return match.group(1).lower() if match else None
+
+
+def detect_places(query: str) -> tuple:
+    """District / dropping point names mentioned, in order of first mention."""
+    return tuple(dict.fromkeys(m.lower() for m in PLACE_PATTERN.findall(query)))
 
 
 def detect_query_type(query: str) -> str | None:
@@ -209,61 +254,214 @@ def format_docs(docs) -> str:
 
 
 # ======================================================
-#          Build RAG Chain
+#          Build Retriever
 # ======================================================
-def get_rag_chain(provider: str = None, query: str = None):
+# Retrieval depth: every extra chunk lengthens the Gemini prompt, so stay
+# small by default and only widen for broad "list everything" questions
+DEFAULT_K = 6
+FARE_K = 4
+BROAD_K = 10
+BROAD_QUERY_PATTERN = re.compile(r"\b(all|list|every)\b", re.IGNORECASE)
+
+
+# Cues that a question refers back to the previously discussed provider:
+# a leading "and ..." / "what about ...", or a plain pronoun ("their
+# refund policy?") when the query names no subject of its own. Relative
+# and demonstrative words (that/this/it) are not cues: "Which providers
+# have a luggage policy that allows bicycles?" is a cross-provider question.
+LEADING_FOLLOW_UP_PATTERN = re.compile(r"^\s*(and|also|what about|how about)\b", re.IGNORECASE)
+PRONOUN_FOLLOW_UP_PATTERN = re.compile(r"\b(their|its|they|them)\b", re.IGNORECASE)
+OWN_SUBJECT_PATTERN = re.compile(
+    r"\b(which|who|any|providers?|compan(y|ies)|operators?)\b",
+    re.IGNORECASE
+)
+
+
+def is_follow_up(query: str) -> bool:
+    """True when the query points back at earlier context and is not a broad question."""
+    if BROAD_QUERY_PATTERN.search(query):
+        return False
+    if LEADING_FOLLOW_UP_PATTERN.search(query):
+        return True
+    return bool(PRONOUN_FOLLOW_UP_PATTERN.search(query)) and not OWN_SUBJECT_PATTERN.search(query)
+
+
+def choose_k(query: str = None) -> int:
+    """Pick how many chunks to retrieve for a query."""
+    if not query:
+        return DEFAULT_K
+    if len(query.split()) > 15 or BROAD_QUERY_PATTERN.search(query):
+        return BROAD_K
+    if detect_query_type(query) == "dropping_point":
+        return FARE_K   # fare records are short and very specific
+    return DEFAULT_K
+
+
+def get_retriever(provider: str = None, query: str = None, k: int = None):
     """
-    Build a LangChain RAG chain with smart filtering.
+    Get a retriever with smart filtering.
     - Provider filter: only chunks from that provider
     - Type filter: policy / dropping_point / provider
     - Price filter: $lte / $gte / $eq on metadata price field
+    - k: chunks to retrieve (adaptive via choose_k when not given)
     """
     where_filter = build_filter(provider=provider, query=query)
+    k = k or choose_k(query)
+
+    # Filters are dicts, so key the retriever cache on their canonical JSON form
+    filter_key = json.dumps(where_filter, sort_keys=True) if where_filter else None
+    return _build_retriever(filter_key, k)
 
-    # Adaptive k:
-    # Policy queries need more chunks (long text split into many pieces)
-    # Fare/price queries need fewer (very specific records)
-    query_type = detect_query_type(query) if query else None
-    if query_type == "policy":
-        k = 8
-    elif query_type == "dropping_point":
-        k = 6
-    else:
-        k = 10
 
+@lru_cache(maxsize=64)
+def _build_retriever(filter_key: str | None, k: int):
+    """
+    Build the retriever once per filter + k.
+    It is stateless, so cached instances are safe to share across requests.
+    """
     search_kwargs = {"k": k}
-    if where_filter:
-        search_kwargs["filter"] = where_filter
+    if filter_key:
+        search_kwargs["filter"] = json.loads(filter_key)
 
-    retriever = vectordb.as_retriever(
+    return vectordb.as_retriever(
         search_type="similarity",
         search_kwargs=search_kwargs
     )
 
-    chain = (
-        {
-            "context": retriever | format_docs,
-            "question": RunnablePassthrough()
-        }
-        | PROMPT
-        | gemini_llm
-        | StrOutputParser()
+
+# ======================================================
+#          Answer Cache
+# ======================================================
+# Exact + semantic cache: repeated or paraphrased questions skip retrieval
+# and the Gemini call. Entries are scoped by provider, query type, price
+# filter and the places mentioned, so e.g. "under 500" never reuses an answer
+# for "under 600", nor one stop's fare another's.
+ANSWER_CACHE_SIZE = 512
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+_answer_cache: OrderedDict = OrderedDict()   # (scope, normalized query) -> (embedding, answer)
+_answer_cache_lock = threading.Lock()
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", query.lower())).strip()
+
+
+def _cache_key(query: str, provider: str | None) -> tuple:
+    scope = (
+        provider,
+        detect_query_type(query),
+        json.dumps(extract_price_filter(query), sort_keys=True),
+        detect_places(query)
     )
+    return scope, normalize_query(query)
+
+
+def _get_cached_answer(key: tuple) -> str | None:
+    """Exact hit on the normalized query."""
+    with _answer_cache_lock:
+        entry = _answer_cache.get(key)
+        if entry is None:
+            return None
+        _answer_cache.move_to_end(key)
+        return entry[1]
+
+
+def _get_similar_answer(key: tuple, embedding: np.ndarray) -> str | None:
+    """Semantic hit: a cached query in the same scope with cosine >= threshold."""
+    scope = key[0]
+    with _answer_cache_lock:
+        for cached_key, (cached_embedding, answer) in reversed(_answer_cache.items()):
+            # Embeddings are L2-normalized, so the dot product is the cosine
+            if cached_key[0] == scope and float(cached_embedding @ embedding) >= SEMANTIC_CACHE_THRESHOLD:
+                _answer_cache.move_to_end(cached_key)
+                return answer
+    return None
+
+
+def _set_cached_answer(key: tuple, embedding: np.ndarray, answer: str):
+    with _answer_cache_lock:
+        _answer_cache[key] = (embedding, answer)
+        _answer_cache.move_to_end(key)
+        while len(_answer_cache) > ANSWER_CACHE_SIZE:
+            _answer_cache.popitem(last=False)
+
 
-    return chain, retriever
+# Identical questions arriving while the first is still being answered
+# (double submits, retries) wait for that answer instead of calling Gemini
+# again. Only touched from the event loop, so no lock is needed.
+_inflight_answers: dict = {}   # cache key -> Future of the answer
+
+
+async def _await_inflight(key: tuple) -> str | None:
+    """Answer of an identical query already being generated, or None."""
+    pending = _inflight_answers.get(key)
+    if pending is None:
+        return None
+    try:
+        return await asyncio.shield(pending)
+    except asyncio.CancelledError:
+        if not pending.cancelled():
+            raise
+        return None   # that request failed or disconnected; answer it here
+
+
+@contextmanager
+def _inflight(key: tuple):
+    """Register the current request as the one answering this key."""
+    pending = asyncio.get_running_loop().create_future()
+    _inflight_answers[key] = pending
+    try:
+        yield pending
+    finally:
+        if _inflight_answers.get(key) is pending:
+            del _inflight_answers[key]
+        if not pending.done():
+            pending.cancel()
+
+
+async def _aretrieve_by_vector(provider: str | None, query: str, embedding: np.ndarray) -> list:
+    """Retrieve with the cache's query embedding instead of embedding the query again."""
+    retriever = get_retriever(provider=provider, query=query)
+    return await vectordb.asimilarity_search_by_vector(embedding.tolist(), **retriever.search_kwargs)
 
 
 # ======================================================
 #          Public API
 # ======================================================
-def get_answer(query: str, provider: str = None) -> str:
+async def astream_answer(query: str, provider: str = None):
     """
-    Get a plain answer string for a user query.
+    Answer a user query, yielding text as Gemini produces it.
     Provider is auto-detected from query if not passed explicitly.
+    Cache hits are yielded whole; a fresh answer is cached once fully streamed.
     """
     provider = provider or detect_provider_from_query(query)
-    chain, _ = get_rag_chain(provider=provider, query=query)
-    return chain.invoke(query)
+    key = _cache_key(query, provider)
+    answer = _get_cached_answer(key) or await _await_inflight(key)
+    if answer is not None:
+        yield answer
+        return
+
+    with _inflight(key) as pending:
+        embedding = np.asarray(await embedding_model.aembed_query(query))
+        answer = _get_similar_answer(key, embedding)
+        if answer is None:
+            docs = await _aretrieve_by_vector(provider, query, embedding)
+            parts = []
+            async for chunk in answer_chain.astream({"context": format_docs(docs), "question": query}):
+                parts.append(chunk)
+                yield chunk
+            answer = "".join(parts)
+        else:
+            yield answer
+        _set_cached_answer(key, embedding, answer)
+        pending.set_result(answer)
+
+
+async def aget_answer(query: str, provider: str = None) -> str:
+    """Full answer string for a user query (astream_answer, collected)."""
+    return "".join([chunk async for chunk in astream_answer(query, provider)])
 
 
 def get_answer_with_sources(query: str, provider: str = None) -> dict:
@@ -272,10 +470,11 @@ def get_answer_with_sources(query: str, provider: str = None) -> dict:
     Returns: { answer: str, source_documents: list[Document] }
     """
     provider = provider or detect_provider_from_query(query)
-    chain, retriever = get_rag_chain(provider=provider, query=query)
+    retriever = get_retriever(provider=provider, query=query)
 
+    # Retrieve once: the same docs feed the answer and the response
     docs = retriever.invoke(query)
-    answer = chain.invoke(query)
+    answer = answer_chain.invoke({"context": format_docs(docs), "question": query})
 
     return {
         "answer": answer,
@@ -1,21 +1,50 @@
+// ===== API Requests =====
+// Same-origin fetch with a timeout, so a hung backend never holds a
+// connection (browsers allow only ~6 per host) or leaves the UI waiting
+const API_TIMEOUT_MS = 10000;
+const LLM_TIMEOUT_MS = 60000;
+
+function apiFetch(url, options = {}, timeoutMs = API_TIMEOUT_MS) {
+    return fetch(url, { ...options, signal: AbortSignal.timeout(timeoutMs) });
+}
+
+// ===== Phone Numbers =====
+// Pasted numbers like "+88 017-1234 5678" reduce to the local 01XXXXXXXXX form
+const PHONE_SEPARATORS = /[\s\-()]/g;
+const PHONE_COUNTRY_PREFIX = /^\+?88(?=01)/;
+
+function normalizePhone(phone) {
+    return phone.replace(PHONE_SEPARATORS, '').replace(PHONE_COUNTRY_PREFIX, '');
+}
+
 // ===== Backend Status Check =====
+// The last result is kept in sessionStorage, so navigating between pages
+// shows it immediately and only re-probes once it is older than this
+const STATUS_MAX_AGE_MS = 10000;
+
+function showStatus(dot, online) {
+    dot.classList.toggle('online', online);
+    dot.classList.toggle('offline', !online);
+    dot.title = online ? 'Backend connected' : 'Backend offline';
+}
+
 async function checkStatus() {
     const dot = document.getElementById('statusDot');
     if (!dot) return;
-    try {
-        const res = await fetch('/stats', { signal: AbortSignal.timeout(2000) });
-        if (res.ok) {
-            dot.classList.add('online');
-            dot.classList.remove('offline');
-            dot.title = 'Backend connected';
-        } else {
-            throw new Error();
-        }
-    } catch {
-        dot.classList.add('offline');
-        dot.classList.remove('online');
-        dot.title = 'Backend offline';
+
+    const last = JSON.parse(sessionStorage.getItem('backendStatus') || 'null');
+    if (last) {
+        showStatus(dot, last.online);
+        if (Date.now() - last.checkedAt < STATUS_MAX_AGE_MS) return;
     }
+
+    let online = false;
+    try {
+        const res = await apiFetch('/health', {}, 2000);
+        online = res.ok;
+    } catch {}
+    showStatus(dot, online);
+    sessionStorage.setItem('backendStatus', JSON.stringify({ online, checkedAt: Date.now() }));
 }
 checkStatus();
 